@@ -3,12 +3,26 @@ from dotenv import load_dotenv
 import os
 from discord.ext import commands, tasks
 import sqlite3
-from datetime import datetime, timezone, timedelta
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from datetime import datetime, timedelta
 import asyncio
 import subprocess
-from itertools import zip_longest
+import sys
+import io
+import threading
+import resource
+import gzip
+import tempfile
+import secrets
+import time
+from collections import Counter, OrderedDict
+from bisect import bisect_right
+from multiprocessing.connection import Client
+from leaderboard_queries import (
+    get_window_leaderboard,
+    get_worker_address,
+    get_worker_authkey,
+    leaderboard_windows,
+)
 
 
 ### Helper functions ###
@@ -22,7 +36,7 @@ def get_env_value(key):
 
 async def admin_message(message):
     if admin_user is not None:
-        await admin_user.send(message)
+        await rest_call("dm", False, None, admin_user.send, message)
 
 
 def check_int(i):
@@ -62,76 +76,175 @@ def point_history(points):
 
 
 def map_doubloons_to_rank(value):
-    if 0 <= value <= 99:
-        return "skull"
-    elif 100 <= value <= 499:
-        return "bronze"
-    elif 500 <= value <= 999:
-        return "iron"
-    elif 1000 <= value <= 2499:
-        return "mithril"
-    elif 2500 <= value <= 4999:
-        return "adamant"
-    elif 5000 <= value <= 9999:
-        return "runite"
-    else:
-        return "dragon"
+    # Values below the lowest threshold still land in the lowest tier
+    index = bisect_right(tier_thresholds, value) - 1
+    return tier_names[max(index, 0)]
+
+
+def load_rank_tiers():
+    with db:
+        c = db.cursor()
+        c.execute("SELECT threshold, name, role_id FROM rank_tiers ORDER BY threshold")
+        tiers = c.fetchall()
+    c.close()
+
+    tier_thresholds[:] = [tier[0] for tier in tiers]
+    tier_names[:] = [tier[1] for tier in tiers]
+    tier_role_ids[:] = [tier[2] for tier in tiers]
 
 
 def populate_roles(guild):
-    roles = []
-    roles.append(guild.get_role(get_int(bronze_role)))
-    roles.append(guild.get_role(get_int(iron_role)))
-    roles.append(guild.get_role(get_int(mithril_role)))
-    roles.append(guild.get_role(get_int(adamant_role)))
-    roles.append(guild.get_role(get_int(runite_role)))
-    roles.append(guild.get_role(get_int(dragon_role)))
-    return roles
+    tier_roles = [
+        guild.get_role(role_id) if role_id is not None else None
+        for role_id in tier_role_ids
+    ]
 
+    # Each rank holds its own role and every role below it
+    rank_roles.clear()
+    held_roles = []
+    for name, role in zip(tier_names, tier_roles):
+        if role is not None:
+            held_roles = held_roles + [role]
+        rank_roles[name] = held_roles
 
-def get_roles(rank):
-    final_roles = []
-    if rank == "skull":
-        return final_roles
+    return [role for role in tier_roles if role is not None]
 
-    for role in roles:
-        final_roles.append(role)
-        if role.name.lower() == rank:
-            return final_roles
 
-    return final_roles
+def get_roles(rank):
+    return rank_roles.get(rank, [])
 
 
-async def handle_rank_transition(user_id, rank):
+async def handle_rank_transition(user_id, rank, old_role=None):
     log_debug(f"In handle_rank_transition {user_id}, {rank}")
     if guild is not None and roles is not None:
-        member = guild.get_member(get_int(user_id))
+        # Cached members keep the roles they had when cached, add_roles/remove_roles
+        # don't update them and the recent cache gets no member updates
+        member = await get_member(user_id, fresh=True)
         if member is not None:
             new_roles = get_roles(rank)
-            await member.remove_roles(*roles)
-            await member.add_roles(*new_roles)
+
+            # A role replaced by settier is no longer in roles but may still be held
+            held_roles = roles if old_role is None else roles + [old_role]
+
+            # discord.py sends one request per role, so only touch the roles that change
+            for role in held_roles:
+                if role not in new_roles and role in member.roles:
+                    await rest_call("roles", False, None, member.remove_roles, role)
+            for role in new_roles:
+                if role not in member.roles:
+                    await rest_call("roles", False, None, member.add_roles, role)
         else:
             log_debug(f"Membber is null: {user_id}, {member}")
     else:
         log_error(f"Guild or roles is null: {guild} {roles}")
 
 
-### END ###
+async def apply_doubloon_change(user_id, username, delta):
+    with db:
+        c = db.cursor()
+        c.execute(
+            """
+        INSERT OR IGNORE INTO users (id, username, doubloons, rank)
+        VALUES (?, ?, ?, ?)
+        """,
+            (user_id, username, 0, tier_names[0]),
+        )
 
-### Initializing constants
+        # Get the user to check if rank needs to be updated
+        c.execute(
+            """
+            SELECT doubloons, rank
+            FROM users
+            WHERE id = ?
+        """,
+            (user_id,),
+        )
+        result = c.fetchone()
 
-# Google sheets config
-scopes = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive",
-]
+        new_doubloons = get_int(result[0]) + delta
+        rank = map_doubloons_to_rank(new_doubloons)
+
+        # Update the user's doubloons value in the database
+        c.execute(
+            """
+        UPDATE users
+        SET doubloons = ?, username = ?, rank = ?
+        WHERE id = ?
+        """,
+            (new_doubloons, username, rank, user_id),
+        )
+
+        c.execute(
+            """
+        INSERT INTO daily_doubloons (day, user_id, delta)
+        VALUES (?, ?, ?)
+        ON CONFLICT (day, user_id) DO UPDATE SET delta = delta + excluded.delta
+        """,
+            (f"{datetime.now():%Y-%m-%d}", user_id, delta),
+        )
+    c.close()
+
+    mark_leaderboard_changed()
+
+    # Role edits are Discord REST calls, keep them off the balance path
+    if rank != result[1]:
+        submit_job("roles", handle_rank_transition, user_id, rank)
+
+    return new_doubloons
+
+
+def remember_member(member):
+    if member_cache_mode != "recent" or not isinstance(member, discord.Member):
+        return
+
+    recent_members[member.id] = member
+    recent_members.move_to_end(member.id)
+    if len(recent_members) > member_cache_size:
+        recent_members.popitem(last=False)
+
+
+async def get_member(user_id, fresh=False):
+    user_id = get_int(user_id)
+
+    if not fresh:
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+
+        member = recent_members.get(user_id)
+        if member is not None:
+            recent_members.move_to_end(user_id)
+            return member
+
+    # Callers asking for the same member share one fetch
+    if user_id not in member_fetches:
+        member_fetches[user_id] = asyncio.create_task(fetch_member(user_id))
+
+    return await asyncio.shield(member_fetches[user_id])
 
-credentials = ServiceAccountCredentials.from_json_keyfile_name(
-    "google_sheet.json", scopes  # type: ignore this function accepts arrays...
-)
 
-file = gspread.authorize(credentials)
-# END Google sheets config
+async def fetch_member(user_id):
+    try:
+        member = await rest_call(
+            "fetch_member", True, None, guild.fetch_member, user_id
+        )
+    except discord.NotFound:
+        return None
+    finally:
+        member_fetches.pop(user_id, None)
+
+    remember_member(member)
+    return member
+
+
+def get_memory_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+### END ###
+
+### Initializing constants
 
 # Load environment variables
 load_dotenv()
@@ -143,12 +256,24 @@ admins = get_env_value("DISCORD_ADMINS")
 debug_channel = get_env_value("DEBUG_CHANNEL")
 db_path = get_env_value("DB_PATH")
 guild_id = get_env_value("GUILD_ID")
-bronze_role = get_env_value("BRONZE_ROLE")
-iron_role = get_env_value("IRON_ROLE")
-mithril_role = get_env_value("MITHRIL_ROLE")
-adamant_role = get_env_value("ADAMANT_ROLE")
-runite_role = get_env_value("RUNITE_ROLE")
-dragon_role = get_env_value("DRAGON_ROLE")
+# Role ids only seed the rank_tiers table on first run
+bronze_role = os.getenv("BRONZE_ROLE")
+iron_role = os.getenv("IRON_ROLE")
+mithril_role = os.getenv("MITHRIL_ROLE")
+adamant_role = os.getenv("ADAMANT_ROLE")
+runite_role = os.getenv("RUNITE_ROLE")
+dragon_role = os.getenv("DRAGON_ROLE")
+# "spawn" starts the Sheets worker with the bot, "external" expects it to be run separately
+sheets_worker_mode = os.getenv("SHEETS_WORKER", "spawn")
+# A spawned worker gets a fresh key, an external one must share SHEETS_WORKER_KEY (hex)
+if sheets_worker_mode == "spawn":
+    sheets_worker_key = secrets.token_bytes(32)
+else:
+    sheets_worker_key = get_worker_authkey()
+sheets_sync_timeout = get_int(os.getenv("SHEETS_SYNC_TIMEOUT"), 300)
+# "full" caches every guild member, "recent" keeps a bounded cache of active members
+member_cache_mode = os.getenv("MEMBER_CACHE", "full")
+member_cache_size = get_int(os.getenv("MEMBER_CACHE_SIZE"), 1000)
 # END Load environment variables
 
 # Bot config
@@ -156,13 +281,27 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+if member_cache_mode == "recent":
+    bot = commands.Bot(
+        command_prefix="!",
+        intents=intents,
+        chunk_guilds_at_startup=False,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+
+recent_members = OrderedDict()
+
+member_fetches = {}
 # END Bot config
 
 # Database config
 db = sqlite3.connect(db_path)
 
 c = db.cursor()
+# WAL lets the Sheets worker read a consistent snapshot while the bot keeps writing
+c.execute("PRAGMA journal_mode=WAL")
 c.execute(
     """
 CREATE TABLE IF NOT EXISTS users (
@@ -173,6 +312,44 @@ CREATE TABLE IF NOT EXISTS users (
 )
 """
 )
+c.execute("CREATE INDEX IF NOT EXISTS users_rank_doubloons ON users (rank, doubloons)")
+# id is the rowid, so this also covers (doubloons, id) for leaderboard pages
+c.execute("CREATE INDEX IF NOT EXISTS users_doubloons ON users (doubloons)")
+# Per user doubloon change for each day, backs the windowed leaderboards
+c.execute(
+    """
+CREATE TABLE IF NOT EXISTS daily_doubloons (
+    day TEXT,
+    user_id INTEGER,
+    delta INTEGER,
+    PRIMARY KEY (day, user_id)
+)
+"""
+)
+# Rank thresholds, names and roles, the lowest tier is the default rank
+c.execute(
+    """
+CREATE TABLE IF NOT EXISTS rank_tiers (
+    threshold INTEGER UNIQUE,
+    name TEXT PRIMARY KEY,
+    role_id INTEGER
+)
+"""
+)
+c.execute("SELECT COUNT(*) FROM rank_tiers")
+if c.fetchone()[0] == 0:
+    c.executemany(
+        "INSERT INTO rank_tiers (threshold, name, role_id) VALUES (?, ?, ?)",
+        [
+            (0, "skull", None),
+            (100, "bronze", get_int(bronze_role, None)),
+            (500, "iron", get_int(iron_role, None)),
+            (1000, "mithril", get_int(mithril_role, None)),
+            (2500, "adamant", get_int(adamant_role, None)),
+            (5000, "runite", get_int(runite_role, None)),
+            (10000, "dragon", get_int(dragon_role, None)),
+        ],
+    )
 db.commit()
 c.close()
 # END Database config
@@ -180,29 +357,321 @@ c.close()
 # Constants
 adminsarray = admins.split()
 
+# Sorted tier thresholds and what they map to, loaded from rank_tiers
+tier_thresholds = []
+tier_names = []
+tier_role_ids = []
+
+# Roles each rank should hold, cached when the guild is ready
+rank_roles = {}
+
+# Rank for a users row straight from rank_tiers, used for bulk re-ranking
+rank_for_doubloons_sql = """
+COALESCE(
+    (SELECT name FROM rank_tiers WHERE threshold <= users.doubloons ORDER BY threshold DESC LIMIT 1),
+    (SELECT name FROM rank_tiers ORDER BY threshold LIMIT 1)
+)"""
+
 emoji_doubloon_map = {
     "☑️": 10,
     "✅": 3,
 }
 
-categories = {
-    "skull": [],
-    "bronze": [],
-    "iron": [],
-    "mithril": [],
-    "adamant": [],
-    "runite": [],
-    "dragon": [],
-}
+# Interactive leaderboard page sizes, buttons stop working after the timeout
+leaderboard_page_size = 20
+leaderboard_max_page_size = 25
+leaderboard_view_timeout = 300
 
 valid_emojis = ["☑️", "✅"]
 
 lock = asyncio.Lock()
 
+# Sheets sync fires after a quiet period, too many pending changes, or max staleness
+sync_quiet_seconds = 30
+sync_max_pending = 25
+sync_max_stale_seconds = 600
+
+# Start dirty so a restart picks up anything the sheet missed
+leaderboard_changes = {"pending": 1, "first": datetime.now(), "last": datetime.now()}
+
+leaderboard_changed = asyncio.Event()
+
+leaderboard_sync = None
+
+sheets_worker_process = None
+
+sheets_worker_status = {
+    "last_sync": None,
+    "users": 0,
+    "read_seconds": 0.0,
+    "write_seconds": 0.0,
+    "round_trip_seconds": 0.0,
+    "error": None,
+}
+
+# Lower priority number runs first, max_queued of 0 means waiting jobs are never shed.
+# A job that has waited max_defer_seconds stops yielding to higher classes, 0 means it always yields
+job_classes = {
+    "balance": {"priority": 0, "limit": 4, "max_queued": 0, "max_defer_seconds": 0},
+    "query": {"priority": 1, "limit": 4, "max_queued": 20, "max_defer_seconds": 5},
+    "roles": {"priority": 2, "limit": 2, "max_queued": 0, "max_defer_seconds": 60},
+    "sheets": {"priority": 3, "limit": 1, "max_queued": 1, "max_defer_seconds": 30},
+    "uploads": {"priority": 4, "limit": 1, "max_queued": 2, "max_defer_seconds": 60},
+}
+
+job_stats = {
+    job_class: {
+        "queued": 0,
+        "running": 0,
+        "max_queued": 0,
+        "completed": 0,
+        "shed": 0,
+        "aged": 0,
+        "wait_seconds": 0.0,
+    }
+    for job_class in job_classes
+}
+
+job_condition = asyncio.Condition()
+
+background_jobs = set()
+
+# Event loop lag monitor, off by default
+lag_interval_seconds = 0.5
+lag_threshold_seconds = 0.25
+slow_callback_seconds = 0.1
+
+lag_stats = {"samples": 0, "total": 0.0, "max": 0.0, "slow": 0, "slow_callbacks": 0}
+
+lag_monitor = None
+
+# Every loop callback goes through Handle._run, the monitor times it while it runs
+handle_run = asyncio.Handle._run
+
+# Sampling profiler, only one can run at a time
+profile_interval_seconds = 0.005
+profile_max_seconds = 300
+profile_stack_depth = 12
+
+profiler = {"stop": None, "thread": None, "timer": None, "samples": Counter()}
+
+# Conservative (requests, seconds) budgets per REST route, calls are paced to stay under them
+rest_routes = {
+    "global": (40, 1),
+    "fetch_message": (5, 1),
+    "fetch_user": (5, 1),
+    "fetch_member": (5, 1),
+    "roles": (5, 5),
+    "dm": (5, 5),
+}
+
+rest_buckets = {
+    route: {"tokens": float(limit), "updated": 0.0}
+    for route, (limit, per) in rest_routes.items()
+}
+
+rest_stats = {
+    route: {"calls": 0, "merged": 0, "throttled": 0, "rate_limited": 0}
+    for route in rest_routes
+    if route != "global"
+}
+
+rest_waiting = {"urgent": 0}
+
+rest_inflight = {}
+
+# Upload limit outside of guilds, parts are cut below the limit to leave room for the gzip trailer
+default_upload_limit = 8 * 1024 * 1024
+upload_limit_margin = 0.9
+
+load_rank_tiers()
+
 # END Constants
 
 ### END Initializing constants
 
+### Job scheduler
+
+
+class JobShedError(Exception):
+    pass
+
+
+def job_can_start(job_class, queued_at):
+    config = job_classes[job_class]
+    if job_stats[job_class]["running"] >= config["limit"]:
+        return False
+
+    # Anything waiting in a higher priority class goes first
+    blocked = any(
+        other_config["priority"] < config["priority"]
+        and job_stats[other_class]["queued"] > 0
+        for other_class, other_config in job_classes.items()
+    )
+    if not blocked:
+        return True
+
+    # Bulk work above, like a re-rank queueing a role job per member, must not starve us.
+    # Blocked waiters are woken whenever a job finishes, so the age gets rechecked
+    max_defer = config["max_defer_seconds"]
+    if max_defer and (datetime.now() - queued_at).total_seconds() >= max_defer:
+        job_stats[job_class]["aged"] += 1
+        return True
+
+    return False
+
+
+async def run_job(job_class, job, *args):
+    config = job_classes[job_class]
+    stats = job_stats[job_class]
+
+    if config["max_queued"] and stats["queued"] >= config["max_queued"]:
+        stats["shed"] += 1
+        log_debug(f"Shed {job_class} job {job.__name__}, {stats['queued']} queued")
+        raise JobShedError(job_class)
+
+    stats["queued"] += 1
+    stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+    queued_at = datetime.now()
+    started = False
+
+    try:
+        async with job_condition:
+            await job_condition.wait_for(lambda: job_can_start(job_class, queued_at))
+            stats["queued"] -= 1
+            stats["running"] += 1
+            started = True
+
+        stats["wait_seconds"] += (datetime.now() - queued_at).total_seconds()
+
+        return await job(*args)
+    finally:
+        if started:
+            stats["running"] -= 1
+            stats["completed"] += 1
+        else:
+            stats["queued"] -= 1
+
+        async with job_condition:
+            job_condition.notify_all()
+
+
+def finish_background_job(task):
+    background_jobs.discard(task)
+
+    if task.cancelled():
+        return
+
+    error = task.exception()
+    if isinstance(error, JobShedError):
+        return
+    if error is not None:
+        log_error(f"Background job failed: {error!r}")
+
+
+def submit_job(job_class, job, *args):
+    task = asyncio.create_task(run_job(job_class, job, *args))
+    background_jobs.add(task)
+    task.add_done_callback(finish_background_job)
+    return task
+
+
+### END Job scheduler
+
+### REST client
+
+
+def refill_rest_bucket(route, now):
+    limit, per = rest_routes[route]
+    bucket = rest_buckets[route]
+    bucket["tokens"] = min(
+        limit, bucket["tokens"] + (now - bucket["updated"]) * limit / per
+    )
+    bucket["updated"] = now
+    return bucket
+
+
+async def take_rest_budget(route, urgent):
+    loop = asyncio.get_running_loop()
+    throttled = False
+
+    if urgent:
+        rest_waiting["urgent"] += 1
+
+    try:
+        while True:
+            now = loop.time()
+            route_bucket = refill_rest_bucket(route, now)
+            global_bucket = refill_rest_bucket("global", now)
+
+            # Non urgent calls hold back while urgent ones are waiting
+            if (
+                route_bucket["tokens"] >= 1
+                and global_bucket["tokens"] >= 1
+                and (urgent or rest_waiting["urgent"] == 0)
+            ):
+                route_bucket["tokens"] -= 1
+                global_bucket["tokens"] -= 1
+                break
+
+            # Waiting behind urgent calls is not a 429 avoided, only an empty bucket is
+            if route_bucket["tokens"] < 1 or global_bucket["tokens"] < 1:
+                throttled = True
+            limit, per = rest_routes[route]
+            await asyncio.sleep(max((1 - route_bucket["tokens"]) * per / limit, 0.05))
+    finally:
+        if urgent:
+            rest_waiting["urgent"] -= 1
+
+    if throttled:
+        rest_stats[route]["throttled"] += 1
+
+
+async def run_rest_call(route, urgent, call, *args):
+    await take_rest_budget(route, urgent)
+
+    rest_stats[route]["calls"] += 1
+    try:
+        return await call(*args)
+    except discord.HTTPException as e:
+        if e.status == 429:
+            rest_stats[route]["rate_limited"] += 1
+        raise
+
+
+async def rest_call(route, urgent, key, call, *args):
+    if key is None:
+        return await run_rest_call(route, urgent, call, *args)
+
+    # Identical requests already in flight share the same response
+    if key in rest_inflight:
+        rest_stats[route]["merged"] += 1
+        return await asyncio.shield(rest_inflight[key])
+
+    task = asyncio.create_task(run_rest_call(route, urgent, call, *args))
+    rest_inflight[key] = task
+    task.add_done_callback(lambda _: rest_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def fetch_message(channel, message_id):
+    return await rest_call(
+        "fetch_message",
+        True,
+        ("fetch_message", channel.id, message_id),
+        channel.fetch_message,
+        message_id,
+    )
+
+
+async def fetch_user(user_id):
+    return await rest_call(
+        "fetch_user", True, ("fetch_user", str(user_id)), bot.fetch_user, user_id
+    )
+
+
+### END REST client
+
 ### Bot events
 
 
@@ -211,7 +680,7 @@ async def on_ready():
     assert bot.user is not None
 
     global admin_user
-    admin_user = await bot.fetch_user(int(admin))
+    admin_user = await fetch_user(int(admin))
 
     global guild
     guild = bot.get_guild(get_int(guild_id))
@@ -219,10 +688,21 @@ async def on_ready():
     global roles
     roles = populate_roles(guild)
 
+    memory_report = f"Member cache {member_cache_mode}: {len(guild.members)} members cached, {get_memory_mb():.0f} MB max resident"
+    print(memory_report)
+    log_debug(memory_report)
+
+    start_sheets_worker()
+
     print(f"{bot.user.display_name} is online")
     updateleaderboard_task.start()
 
 
+@bot.before_invoke
+async def remember_command_user(ctx):
+    remember_member(ctx.author)
+
+
 @bot.event
 async def on_raw_reaction_add(payload):
     if str(payload.user_id) not in adminsarray:
@@ -238,6 +718,14 @@ async def on_raw_reaction_add(payload):
     if reaction.name not in valid_emojis:
         return
 
+    remember_member(payload.member)
+
+    await credit_reaction(payload)
+
+
+async def credit_reaction(payload):
+    reaction = payload.emoji
+
     channel = bot.get_channel(payload.channel_id)
 
     if channel is None or type(channel) is not discord.TextChannel:
@@ -247,52 +735,19 @@ async def on_raw_reaction_add(payload):
         )
         return
 
-    message = await channel.fetch_message(payload.message_id)
-
-    user = await bot.fetch_user(payload.user_id)
-    with db:
-        c = db.cursor()
-
-        c.execute(
-            """
-        INSERT OR IGNORE INTO users (id, username, doubloons, rank)
-        VALUES (?, ?, ?, ?)
-        """,
-            (message.author.id, message.author.name, 0, "skull"),
-        )
-
-        # Get the user to check if rank needs to be updated
-        c.execute(
-            """
-            SELECT doubloons, rank
-            FROM users
-            WHERE id = ?
-        """,
-            (message.author.id,),
-        )
-        result = c.fetchone()
-
-        new_doubloons = get_int(result[0]) + emoji_doubloon_map[reaction.name]
-        rank = map_doubloons_to_rank(new_doubloons)
-        if rank != result[1]:
-            await handle_rank_transition(message.author.id, rank)
+    message = await fetch_message(channel, payload.message_id)
+    remember_member(message.author)
 
-        # Update the user's doubloons value in the database
-        c.execute(
-            """
-        UPDATE users
-        SET doubloons = ?, username = ?, rank = ?
-        WHERE id = ?
-        """,
-            (
-                new_doubloons,
-                message.author.name,
-                rank,
-                message.author.id,
-            ),
-        )
+    user = await fetch_user(payload.user_id)
 
-    c.close()
+    # Only the DB write holds a balance slot, REST fetches can be paced for a while
+    await run_job(
+        "balance",
+        apply_doubloon_change,
+        message.author.id,
+        message.author.name,
+        emoji_doubloon_map[reaction.name],
+    )
 
     point_history(
         f"{user.display_name} added {emoji_doubloon_map[reaction.name]} doubloons to {message.author.name}"
@@ -317,6 +772,12 @@ async def on_raw_reaction_remove(payload):
         log_error(f"Invalid reaction {reaction.name}")
         return
 
+    await debit_reaction(payload)
+
+
+async def debit_reaction(payload):
+    reaction = payload.emoji
+
     channel = bot.get_channel(payload.channel_id)
 
     if channel is None or type(channel) is not discord.TextChannel:
@@ -326,7 +787,8 @@ async def on_raw_reaction_remove(payload):
         )
         return
 
-    message = await channel.fetch_message(payload.message_id)
+    message = await fetch_message(channel, payload.message_id)
+    remember_member(message.author)
 
     with db:
         c = db.cursor()
@@ -348,57 +810,21 @@ async def on_raw_reaction_remove(payload):
         )
         return
 
-    with db:
-        c = db.cursor()
-
-        # Get the user to check if rank needs to be updated
-        c.execute(
-            """
-            SELECT doubloons, rank
-            FROM users
-            WHERE id = ?
-        """,
-            (message.author.id,),
-        )
-        result = c.fetchone()
-
-        new_doubloons = get_int(result[0]) + emoji_doubloon_map[reaction.name]
-        rank = map_doubloons_to_rank(new_doubloons)
-        if rank != result[1]:
-            await handle_rank_transition(message.author.id, rank)
-
-        # Update the user's doubloons value in the database
-        c.execute(
-            """
-        UPDATE users
-        SET doubloons = ?, username = ?, rank = ?
-        WHERE id = ?
-        """,
-            (
-                new_doubloons,
-                message.author.name,
-                rank,
-                message.author.id,
-            ),
-        )
-    c.close()
+    await run_job(
+        "balance",
+        apply_doubloon_change,
+        message.author.id,
+        message.author.name,
+        -emoji_doubloon_map[reaction.name],
+    )
 
-    user = await bot.fetch_user(payload.user_id)
+    user = await fetch_user(payload.user_id)
 
     point_history(
         f"{user.display_name} removed {emoji_doubloon_map[reaction.name]} doubloons from {message.author.name}"
     )
 
 
-@bot.event
-async def on_command_error(ctx, error):
-    if isinstance(error, commands.CommandOnCooldown):
-        command_history(f"{ctx.author.id} tried updating the leaderboard too fast")
-        await ctx.send(
-            f"Updating sheet too often, try again in {round(error.retry_after)} seconds"
-        )
-
-
 ### END Bot events
 
 
@@ -422,7 +848,7 @@ async def adddoubloons(ctx, *args):
         user_id = user_id[2:-1]
 
     try:
-        user = await bot.fetch_user(user_id)
+        user = await fetch_user(user_id)
     except discord.NotFound:
         await ctx.send(f"User ID {user_id} does not exist")
         return
@@ -433,58 +859,20 @@ async def adddoubloons(ctx, *args):
         await ctx.send(f"{doubloon_count} is not a valid number of doubloons!")
         return
 
-    with db:
-        c = db.cursor()
-        c.execute(
-            """
-        INSERT OR IGNORE INTO users (id, username, doubloons, rank)
-        VALUES (?, ?, ?, ?)
-        """,
-            (user_id, user.display_name, 0, "skull"),
-        )
-
-        # Get the user to check if rank needs to be updated
-        c.execute(
-            """
-            SELECT doubloons, rank
-            FROM users
-            WHERE id = ?
-        """,
-            (user_id,),
-        )
-        result = c.fetchone()
-        new_doubloons = get_int(result[0]) + get_int(doubloon_count)
-        rank = map_doubloons_to_rank(new_doubloons)
-
-        if rank != result[1]:
-            await handle_rank_transition(user_id, rank)
-
-        # Update the user's doubloons value in the database
-
-        c.execute(
-            """
-        UPDATE users
-        SET doubloons = ?, username = ?, rank = ?
-        WHERE id = ?
-        """,
-            (
-                new_doubloons,
-                user.display_name,
-                rank,
-                user_id,
-            ),
-        )
-
-        c.execute("SELECT doubloons FROM users WHERE id = ?", (user_id,))
-        result = c.fetchone()
-    c.close()
+    new_doubloons = await run_job(
+        "balance",
+        apply_doubloon_change,
+        user_id,
+        user.display_name,
+        get_int(doubloon_count),
+    )
 
     point_history(
         f"{ctx.author.name} manually added {doubloon_count} doubloons to {user.display_name}"
     )
 
     await ctx.send(
-        f"{doubloon_count} added to {user.display_name}! They now have {result[0]} doubloon(s)!"
+        f"{doubloon_count} added to {user.display_name}! They now have {new_doubloons} doubloon(s)!"
     )
 
     return
@@ -509,7 +897,7 @@ async def removedoubloons(ctx, *args):
         user_id = user_id[2:-1]
 
     try:
-        user = await bot.fetch_user(user_id)
+        user = await fetch_user(user_id)
     except discord.NotFound:
         await ctx.send(f"User ID {user_id} does not exist")
         return
@@ -538,51 +926,97 @@ async def removedoubloons(ctx, *args):
         )
         return
 
+    new_doubloons = await run_job(
+        "balance",
+        apply_doubloon_change,
+        user_id,
+        user.display_name,
+        -get_int(doubloon_count),
+    )
+
+    point_history(
+        f"{ctx.author.name} manually removed {doubloon_count} doubloons from {user.display_name}"
+    )
+    await ctx.send(
+        f"{doubloon_count} doubloons removed from {user.display_name}, they now have {new_doubloons} doubloon(s)!"
+    )
+
+    return
+
+
+@bot.command(name="settier")
+async def settier(ctx, *args):
+    global roles
+
+    command_history(f"{ctx.author.id} used settier with arguments {args}")
+
+    if str(ctx.author.id) not in adminsarray:
+        return
+
+    if len(args) < 2 or args[0] == "help":
+        await ctx.send("settier usage: !settier [name] [threshold] [role id]")
+        return
+
+    name = args[0].lower()
+    threshold = args[1]
+    if not check_int(threshold) or int(threshold) < 0:
+        await ctx.send(f"{threshold} is not a valid threshold!")
+        return
+
+    role_id = None
+    if len(args) > 2:
+        role_id = args[2]
+        if role_id[0] == "<":
+            role_id = role_id[3:-1]
+        if not check_int(role_id):
+            await ctx.send(f"{args[2]} is not a valid role!")
+            return
+        role_id = int(role_id)
+
     with db:
         c = db.cursor()
+        c.execute("SELECT role_id FROM rank_tiers WHERE name = ?", (name,))
+        tier = c.fetchone()
+    c.close()
 
-        # Get the user to check if rank needs to be updated
-        c.execute(
-            """
-            SELECT doubloons, rank
-            FROM users
-            WHERE id = ?
-        """,
-            (user_id,),
-        )
-        result = c.fetchone()
+    # Members at or above the tier hold its role, so a new role has to reach all of them
+    role_changed = role_id is not None and (tier is None or tier[0] != role_id)
+    old_role_id = tier[0] if tier is not None else None
+    if role_changed:
+        holder_ids = get_tier_member_ids(name)
 
-        new_doubloons = get_int(result[0]) - get_int(doubloon_count)
-        rank = map_doubloons_to_rank(new_doubloons)
-        if rank != result[1]:
-            await handle_rank_transition(user_id, rank)
+    try:
+        with db:
+            c = db.cursor()
+            c.execute(
+                """
+            INSERT INTO rank_tiers (threshold, name, role_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET threshold = excluded.threshold, role_id = COALESCE(excluded.role_id, role_id)
+            """,
+                (int(threshold), name, role_id),
+            )
+        c.close()
+    except sqlite3.IntegrityError:
+        await ctx.send(f"Another tier already starts at {threshold} doubloons")
+        return
 
-        # Update the user's doubloons value in the database
+    load_rank_tiers()
+    if guild is not None:
+        roles = populate_roles(guild)
 
-        c.execute(
-            """
-        UPDATE users
-        SET doubloons = ?, username = ?, rank = ?
-        WHERE id = ?
-        """,
-            (
-                new_doubloons,
-                user.display_name,
-                rank,
-                user_id,
-            ),
-        )
-    c.close()
+    changed = await run_job("balance", rerank_users)
+
+    if role_changed and guild is not None:
+        # The old role is no longer in roles, so transitions alone would leave it behind
+        old_role = guild.get_role(old_role_id) if old_role_id is not None else None
+        for user_id in dict.fromkeys(holder_ids + get_tier_member_ids(name)):
+            submit_job("roles", replace_tier_role, user_id, old_role)
 
-    point_history(
-        f"{ctx.author.name} manually removed {doubloon_count} doubloons from {user.display_name}"
-    )
     await ctx.send(
-        f"{doubloon_count} doubloons removed from {user.display_name}, they now have {current_doubloons - int(doubloon_count)} doubloon(s)!"
+        f"{name.capitalize()} now starts at {threshold} doubloons, {changed} member(s) changed rank"
     )
 
-    return
-
 
 @bot.command(name="register")
 async def register(ctx, *args):
@@ -603,7 +1037,7 @@ async def register(ctx, *args):
         user_id = user_id[2:-1]
 
     try:
-        user = await bot.fetch_user(user_id)
+        user = await fetch_user(user_id)
     except discord.NotFound:
         await ctx.send(f"User ID {user_id} does not exist")
         return
@@ -618,7 +1052,7 @@ async def register(ctx, *args):
         INSERT OR IGNORE INTO users (id, username, doubloons, rank)
         VALUES (?, ?, ?, ?)
         """,
-            (user_id, username, 0, "skull"),
+            (user_id, username, 0, tier_names[0]),
         )
 
         # Update the user's doubloons value in the database
@@ -632,6 +1066,8 @@ async def register(ctx, *args):
         )
     c.close()
 
+    mark_leaderboard_changed()
+
     await ctx.send(f"Updated {user_id}'s username to {username}")
 
 
@@ -646,6 +1082,13 @@ async def doubloons(ctx, *args):
         f"{ctx.author.id} checked doubloon count with args {args} arg len {len(args)}"
     )
 
+    try:
+        await run_job("query", send_doubloons, ctx, args)
+    except JobShedError:
+        await ctx.send("Bot is busy, try again in a moment")
+
+
+async def send_doubloons(ctx, args):
     if len(args) < 1:
         user_id = ctx.author.id
     else:
@@ -668,54 +1111,92 @@ async def doubloons(ctx, *args):
 
 
 @bot.command(name="leaderboard")
-async def leaderboard(ctx, arg=25):
-    command_history(f"{ctx.author.id} viewed the leaderboard")
-    with db:
-        c = db.cursor()
-        c.execute("SELECT id, username, doubloons FROM users")
-        users = c.fetchall()
-        sorted_users = sorted(users, key=lambda user: user[2], reverse=True)
-    c.close()
+async def leaderboard(ctx, arg=None, count=25):
+    command_history(f"{ctx.author.id} viewed the leaderboard with args {arg} {count}")
+
+    try:
+        await run_job("query", send_leaderboard, ctx, arg, count)
+    except JobShedError:
+        await ctx.send("Bot is busy, try again in a moment")
 
-    numSentMessages = 0
 
-    numEntries = min(get_int(arg, 25), len(sorted_users))
+async def send_leaderboard(ctx, arg, count):
+    if arg not in leaderboard_windows:
+        page_size = min(
+            max(get_int(arg, leaderboard_page_size), 1), leaderboard_max_page_size
+        )
+        view = LeaderboardView(ctx.author.id, page_size)
+        view.users = get_leaderboard_page_after(None, page_size)
+        view.update_buttons()
+        view.message = await ctx.send(view.render(), view=view)
+        return
 
-    finalCount = numEntries
+    # Same single message as a page of the all-time board, capped to one page
+    limit = min(
+        max(get_int(count, leaderboard_max_page_size), 1), leaderboard_max_page_size
+    )
+    users = get_window_leaderboard(db, leaderboard_windows[arg], limit)
+    await ctx.send(render_leaderboard(f"Leaderboard this {arg}", users, 1))
 
-    leaderboardMessages = []
 
-    leaderboard = ""
+def render_leaderboard(title, users, start):
+    if len(users) == 0:
+        return "No doubloons yet!"
 
-    for i, user in enumerate(sorted_users[:numEntries], start=1):
-        if len(leaderboard) > 1700:
-            if numSentMessages > 1:
-                finalCount = i
-                break
-            leaderboardMessages.append(leaderboard)
-            numSentMessages += 1
-            leaderboard = ""
+    leaderboard = f"{title} {start}-{start + len(users) - 1}:\n"
+    for i, user in enumerate(users, start=start):
         leaderboard += f"{i}. {user[1]} - {user[2]} doubloons\n"
+    leaderboard += f"\nSee the full board here: <{spreadsheet_link}>"
+    return leaderboard
 
-    if finalCount != numEntries:
-        leaderboard += f"\nResults truncated, see the full board here: <{spreadsheet_link}>\nand update it with !updateleaderboard (allow 60 seconds for new changes)"
-    else:
-        leaderboard += f"\nSee the full board here: <{spreadsheet_link}>\nand update it with !updateleaderboard (allow 60 seconds for new changes)"
 
-    leaderboardMessages.append(leaderboard)
+@bot.command(name="ranks")
+async def ranks(ctx):
+    command_history(f"{ctx.author.id} viewed the rank counts")
 
-    leaderboardMessages[0] = f"Leaderboard TOP {finalCount}:\n" + leaderboardMessages[0]
+    try:
+        await run_job("query", send_rank_counts, ctx)
+    except JobShedError:
+        await ctx.send("Bot is busy, try again in a moment")
 
-    for message in leaderboardMessages:
-        await ctx.send(message)
+
+@bot.command(name="tiers")
+async def tiers(ctx):
+    command_history(f"{ctx.author.id} viewed the rank tiers")
+
+    message = "Rank tiers:\n"
+    for threshold, name in zip(reversed(tier_thresholds), reversed(tier_names)):
+        message += f"{name.capitalize()} - {threshold}+ doubloons\n"
+
+    await ctx.send(message)
+
+
+async def send_rank_counts(ctx):
+    message = "Members per rank:\n"
+    for rank, count in reversed(get_rank_counts()):
+        message += f"{rank.capitalize()} - {count}\n"
+
+    await ctx.send(message)
 
 
 @bot.command(name="updateleaderboard")
-@commands.cooldown(1, 60, commands.BucketType.default)
 async def updateleaderboard_command(ctx):
     command_history(f"{ctx.author.id} updated the leaderboard")
 
-    await updateleaderboard()
+    if leaderboard_changes["pending"] == 0 and (
+        leaderboard_sync is None or leaderboard_sync.done()
+    ):
+        await ctx.send(
+            f"Leaderboard already up to date! View it here: <{spreadsheet_link}>"
+        )
+        return
+
+    try:
+        await sync_leaderboard()
+    except Exception as e:
+        log_error(f"Leaderboard sync failed: {e!r}")
+        await ctx.send("Leaderboard update failed, it will be retried automatically")
+        return
 
     await ctx.send(f"Leaderboard up to date! View it here: <{spreadsheet_link}>")
 
@@ -725,73 +1206,394 @@ async def updateleaderboard_command(ctx):
 ### Leaderboard utilities
 
 
+def mark_leaderboard_changed():
+    now = datetime.now()
+    if leaderboard_changes["pending"] == 0:
+        leaderboard_changes["first"] = now
+    leaderboard_changes["pending"] += 1
+    leaderboard_changes["last"] = now
+    leaderboard_changed.set()
+
+
+async def wait_for_leaderboard_changes():
+    while True:
+        if leaderboard_changes["pending"] == 0:
+            leaderboard_changed.clear()
+            await leaderboard_changed.wait()
+            continue
+
+        if leaderboard_changes["pending"] >= sync_max_pending:
+            return
+
+        now = datetime.now()
+        quiet_deadline = leaderboard_changes["last"] + timedelta(
+            seconds=sync_quiet_seconds
+        )
+        stale_deadline = leaderboard_changes["first"] + timedelta(
+            seconds=sync_max_stale_seconds
+        )
+        remaining = (min(quiet_deadline, stale_deadline) - now).total_seconds()
+        if remaining <= 0:
+            return
+
+        # Any new change re-evaluates the deadlines
+        leaderboard_changed.clear()
+        try:
+            await asyncio.wait_for(leaderboard_changed.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def sync_leaderboard():
+    global leaderboard_sync
+
+    # Join the sync already in flight rather than starting another
+    if leaderboard_sync is None or leaderboard_sync.done():
+        leaderboard_sync = asyncio.create_task(run_leaderboard_sync())
+
+    await asyncio.shield(leaderboard_sync)
+
+
+async def run_leaderboard_sync():
+    # Changes made while syncing count towards the next sync
+    pending = leaderboard_changes["pending"]
+    leaderboard_changes["pending"] = 0
+
+    try:
+        await run_job("sheets", updateleaderboard)
+    except Exception:
+        if leaderboard_changes["pending"] == 0:
+            leaderboard_changes["first"] = datetime.now()
+        leaderboard_changes["pending"] += pending
+        leaderboard_changed.set()
+        raise
+
+    command_history(f"Leaderboard synced {pending} change(s)")
+
+
 async def updateleaderboard():
     async with lock:
-        last_update = datetime.utcfromtimestamp(os.path.getmtime(db_path)).replace(
-            tzinfo=timezone.utc
-        )
-        sheet = file.open("Leaderboard")
+        started = datetime.now()
+
+        # The export runs in the Sheets worker process, only wait on its reply here
+        result = await asyncio.to_thread(request_sheets_sync)
 
-        # Grabbing sheet last updated time, and rolling back 60 seconds to buffer for time reporting differences
-        # Also reduces chances of repeated update requests
-        sheettime = datetime.strptime(
-            sheet.lastUpdateTime, "%Y-%m-%dT%H:%M:%S.%f%z"
-        ) - timedelta(seconds=60)
+        sheets_worker_status["round_trip_seconds"] = (
+            datetime.now() - started
+        ).total_seconds()
 
-        # If the database has been not been updated more recently than the sheet, bail out
-        if sheettime > last_update:
-            command_history(
-                f"Bailing out of sheet update - sheet was updated {(sheettime - last_update).seconds} seconds after the DB"
+        if result["status"] != "ok":
+            sheets_worker_status["error"] = result["error"]
+            raise RuntimeError(f"Sheets worker failed: {result['error']}")
+
+        sheets_worker_status["last_sync"] = datetime.now()
+        sheets_worker_status["users"] = result["users"]
+        sheets_worker_status["read_seconds"] = result["read_seconds"]
+        sheets_worker_status["write_seconds"] = result["write_seconds"]
+        sheets_worker_status["error"] = None
+
+    command_history(
+        f"Leaderboard updated, {result['users']} users, read {result['read_seconds']:.2f}s, write {result['write_seconds']:.2f}s"
+    )
+
+
+def request_sheets_sync():
+    # Bring the worker back if it died since the last sync
+    start_sheets_worker()
+
+    conn = connect_sheets_worker()
+    with conn:
+        conn.send("sync")
+        if not conn.poll(sheets_sync_timeout):
+            # The worker serves one sync at a time, a hung one would block every later sync
+            if sheets_worker_process is not None:
+                sheets_worker_process.kill()
+            raise TimeoutError(
+                f"Sheets worker did not reply within {sheets_sync_timeout} seconds"
+            )
+        return conn.recv()
+
+
+def connect_sheets_worker():
+    # A freshly started worker needs a moment to authorize with Google and listen
+    for attempt in range(30):
+        try:
+            return Client(get_worker_address(), authkey=sheets_worker_key)
+        except ConnectionRefusedError:
+            if attempt == 29:
+                raise
+            time.sleep(1)
+
+
+def start_sheets_worker():
+    global sheets_worker_process
+    if sheets_worker_mode != "spawn":
+        return
+
+    if sheets_worker_process is not None and sheets_worker_process.poll() is None:
+        return
+
+    sheets_worker_process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "sheets_worker.py")],
+        env={**os.environ, "SHEETS_WORKER_KEY": sheets_worker_key.hex()},
+    )
+    log_debug(f"Started Sheets worker {sheets_worker_process.pid}")
+
+
+def get_leaderboard_page_after(key, limit):
+    # Keyset pagination on (doubloons, id), every page is an index seek
+    with db:
+        c = db.cursor()
+        if key is None:
+            c.execute(
+                """
+            SELECT id, username, doubloons
+            FROM users
+            ORDER BY doubloons DESC, id DESC
+            LIMIT ?
+            """,
+                (limit,),
             )
-            return
         else:
-            command_history(
-                f"Sheet was updated {(last_update - sheettime).seconds} seconds before the DB, proceeding with update"
+            c.execute(
+                """
+            SELECT id, username, doubloons
+            FROM users
+            WHERE (doubloons, id) < (?, ?)
+            ORDER BY doubloons DESC, id DESC
+            LIMIT ?
+            """,
+                (key[0], key[1], limit),
             )
+        users = c.fetchall()
+    c.close()
+    return users
 
-        worksheet = sheet.sheet1
 
-        with db:
-            c = db.cursor()
-            c.execute("SELECT id, username, doubloons FROM users")
-            users = c.fetchall()
-            sorted_users = sorted(users, key=lambda user: user[2], reverse=True)
-        c.close()
+def get_leaderboard_page_before(key, limit):
+    with db:
+        c = db.cursor()
+        c.execute(
+            """
+        SELECT id, username, doubloons
+        FROM users
+        WHERE (doubloons, id) > (?, ?)
+        ORDER BY doubloons ASC, id ASC
+        LIMIT ?
+        """,
+            (key[0], key[1], limit),
+        )
+        users = c.fetchall()
+    c.close()
+    return list(reversed(users))
 
-        sheet_values = []
 
-        for user in sorted_users:
-            sheet_values.append([user[1], user[2]])
+def get_leaderboard_position(user_id):
+    with db:
+        c = db.cursor()
+        c.execute("SELECT id, doubloons FROM users WHERE id = ?", (user_id,))
+        user = c.fetchone()
+        if user is None:
+            c.close()
+            return None, None
+
+        c.execute(
+            "SELECT COUNT(*) FROM users WHERE (doubloons, id) > (?, ?)",
+            (user[1], user[0]),
+        )
+        position = c.fetchone()[0] + 1
+    c.close()
+    return (user[1], user[0]), position
 
-        worksheet.clear()
-        worksheet.update(f"A1:B{len(sorted_users)}", sheet_values)
 
-        for category in categories.values():
-            category.clear()
+async def rerank_users():
+    with db:
+        c = db.cursor()
+        c.execute(
+            f"""
+        SELECT id, {rank_for_doubloons_sql}
+        FROM users
+        WHERE rank IS NOT {rank_for_doubloons_sql}
+        """
+        )
+        changed = c.fetchall()
 
-        for user in sorted_users:
-            category = map_doubloons_to_rank(get_int(user[2]))
-            categories[category].append(user[1])
+        # One set based update, only rows whose rank moved are touched
+        c.execute(
+            f"""
+        UPDATE users
+        SET rank = {rank_for_doubloons_sql}
+        WHERE rank IS NOT {rank_for_doubloons_sql}
+        """
+        )
+    c.close()
 
-        array = [users for users in categories.values()]
+    for user_id, rank in changed:
+        submit_job("roles", handle_rank_transition, user_id, rank)
 
-        transposed = list(zip_longest(*array, fillvalue=""))
+    if len(changed) > 0:
+        mark_leaderboard_changed()
 
-        worksheet = sheet.worksheet("Ranks")
+    return len(changed)
 
-        worksheet.batch_clear(["A2:G1000"])
-        worksheet.update(f"A2:G{len(transposed) + 1}", transposed)
 
-        log_error(f"A2:G{len(transposed) + 1} {transposed}")
+def get_tier_member_ids(name):
+    # Everyone whose rank is this tier or a higher one
+    with db:
+        c = db.cursor()
+        c.execute(
+            """
+        SELECT users.id
+        FROM users
+        JOIN rank_tiers ON rank_tiers.name = users.rank
+        WHERE rank_tiers.threshold >= (SELECT threshold FROM rank_tiers WHERE name = ?)
+        """,
+            (name,),
+        )
+        user_ids = [user[0] for user in c.fetchall()]
+    c.close()
+    return user_ids
+
+
+async def replace_tier_role(user_id, old_role):
+    # Read the rank when the job runs, later balance changes may have moved it
+    with db:
+        c = db.cursor()
+        c.execute("SELECT rank FROM users WHERE id = ?", (user_id,))
+        user = c.fetchone()
+    c.close()
 
-    command_history("Leaderboard updated")
+    if user is not None:
+        await handle_rank_transition(user_id, user[0], old_role)
 
 
-@tasks.loop(minutes=10)
+def get_rank_counts():
+    with db:
+        c = db.cursor()
+        c.execute("SELECT rank, COUNT(*) FROM users GROUP BY rank")
+        counts = dict(c.fetchall())
+    c.close()
+    return [(rank, counts.get(rank, 0)) for rank in tier_names]
+
+
+class LeaderboardView(discord.ui.View):
+    def __init__(self, author_id, page_size):
+        super().__init__(timeout=leaderboard_view_timeout)
+        self.author_id = author_id
+        self.page_size = page_size
+        self.users = []
+        self.start = 1
+        self.message = None
+
+    def render(self):
+        return render_leaderboard("Leaderboard", self.users, self.start)
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.start <= 1
+        self.next_page.disabled = len(self.users) < self.page_size
+
+    async def interaction_check(self, interaction):
+        # The message is shared, only the person who asked for it can page it
+        if interaction.user.id == self.author_id:
+            return True
+
+        await interaction.response.send_message(
+            "Use !leaderboard to browse your own copy of the board", ephemeral=True
+        )
+        return False
+
+    async def show(self, interaction, job):
+        try:
+            found = await run_job("query", job)
+        except JobShedError:
+            await interaction.response.send_message(
+                "Bot is busy, try again in a moment", ephemeral=True
+            )
+            return
+
+        if not found:
+            await interaction.response.send_message("No doubloons yet!", ephemeral=True)
+            return
+
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    async def load_previous_page(self):
+        if len(self.users) > 0:
+            users = get_leaderboard_page_before(
+                (self.users[0][2], self.users[0][0]), self.page_size
+            )
+            if len(users) < self.page_size:
+                # Short of a full page means we reached the top, show a full first page
+                users = get_leaderboard_page_after(None, self.page_size)
+                self.start = 1
+            else:
+                self.start -= len(users)
+            self.users = users
+        return True
+
+    async def load_next_page(self):
+        if len(self.users) > 0:
+            users = get_leaderboard_page_after(
+                (self.users[-1][2], self.users[-1][0]), self.page_size
+            )
+            if len(users) > 0:
+                self.start += len(self.users)
+                self.users = users
+        return True
+
+    async def load_author_page(self):
+        key, position = get_leaderboard_position(self.author_id)
+        if key is None:
+            return False
+
+        # Show a few people above, then fill the page from the user down
+        above = get_leaderboard_page_before(key, self.page_size // 2)
+        below = get_leaderboard_page_after(
+            (key[0], key[1] + 1), self.page_size - len(above)
+        )
+        self.users = above + below
+        self.start = position - len(above)
+        return True
+
+    @discord.ui.button(label="Prev", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show(interaction, self.load_previous_page)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show(interaction, self.load_next_page)
+
+    @discord.ui.button(label="Jump to me", style=discord.ButtonStyle.primary)
+    async def jump_to_me(self, interaction, button):
+        command_history(
+            f"{interaction.user.id} jumped to themselves on the leaderboard"
+        )
+
+        await self.show(interaction, self.load_author_page)
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+
+@tasks.loop()
 async def updateleaderboard_task():
+    await wait_for_leaderboard_changes()
+
     command_history("Auto updating the leaderboard")
 
-    await updateleaderboard()
+    try:
+        await sync_leaderboard()
+    except Exception as e:
+        log_error(f"Leaderboard sync failed: {e!r}")
+        # Back off instead of retrying a failing sync in a tight loop
+        await asyncio.sleep(sync_quiet_seconds)
 
 
 @updateleaderboard_task.before_loop
@@ -815,12 +1617,119 @@ def get_file_lines(file_name, line_count):
         return f"Error while executing tail command: {e}"
 
 
-async def send_file(ctx, filename):
-    with open(filename, "rb") as f:
-        try:
-            await ctx.send(file=discord.File(f))
-        except Exception as e:
-            print(f"Error sending file: {e}")
+def in_date_range(line, start, end, included):
+    # Lines without a timestamp continue the previous entry
+    day = line[:10]
+    if check_int(day[:4]) and day[4:5] == "-":
+        return (start is None or day >= start) and (end is None or day <= end)
+    return included
+
+
+def compress_log_parts(filename, start, end, part_limit):
+    parts = []
+    part = None
+    raw = None
+    included = True
+
+    try:
+        with open(filename, "rb") as f:
+            for line in f:
+                included = in_date_range(
+                    line.decode(errors="replace"), start, end, included
+                )
+                if not included:
+                    continue
+
+                if part is None:
+                    raw = tempfile.NamedTemporaryFile(suffix=".gz", delete=False)
+                    parts.append(raw.name)
+                    part = gzip.GzipFile(
+                        filename=os.path.basename(filename), fileobj=raw, mode="wb"
+                    )
+
+                part.write(line)
+
+                # The compressed size lags behind what was written, so leave some headroom
+                if raw.tell() >= part_limit:
+                    part.close()
+                    raw.close()
+                    part = None
+
+        if part is not None:
+            part.close()
+            raw.close()
+    except BaseException:
+        # Don't leave half written parts behind in the temp directory
+        if raw is not None:
+            raw.close()
+        for part_name in parts:
+            os.remove(part_name)
+        raise
+
+    return parts
+
+
+async def send_file(ctx, filename, start=None, end=None):
+    upload_limit = default_upload_limit
+    if ctx.guild is not None:
+        upload_limit = ctx.guild.filesize_limit
+
+    try:
+        # Compressing reads the whole log, keep it off the event loop
+        parts = await asyncio.to_thread(
+            compress_log_parts,
+            filename,
+            start,
+            end,
+            int(upload_limit * upload_limit_margin),
+        )
+    except FileNotFoundError:
+        await ctx.send(f"{filename} does not exist yet")
+        return
+
+    if len(parts) == 0:
+        await ctx.send(f"No entries in {filename} for that date range")
+        return
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        for i, part in enumerate(parts, start=1):
+            part_name = f"{name}.txt.gz"
+            if len(parts) > 1:
+                part_name = f"{name}.part{i}of{len(parts)}.txt.gz"
+            try:
+                await ctx.send(file=discord.File(part, filename=part_name))
+            except Exception as e:
+                print(f"Error sending file: {e}")
+                await ctx.send(f"Error sending {part_name}")
+                return
+    finally:
+        for part in parts:
+            os.remove(part)
+
+
+def parse_date_arg(arg):
+    if arg is None:
+        return None
+    try:
+        return f"{datetime.strptime(arg, '%Y-%m-%d'):%Y-%m-%d}"
+    except ValueError:
+        return ""
+
+
+async def queue_file_upload(ctx, filename, start=None, end=None):
+    start = parse_date_arg(start)
+    end = parse_date_arg(end)
+    if start == "" or end == "":
+        await ctx.send(
+            "Dates should look like 2023-06-22, e.g. !pointhistory full 2023-06-01 2023-06-22"
+        )
+        return
+
+    try:
+        await run_job("uploads", send_file, ctx, filename, start, end)
+    except JobShedError:
+        await ctx.send("Too many uploads in progress, try again in a moment")
 
 
 async def send_file_lines(ctx, arg, filename):
@@ -839,6 +1748,139 @@ async def send_file_lines(ctx, arg, filename):
 
 ### END Debug utilities
 
+### Profiling utilities
+
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + lag_interval_seconds
+        await asyncio.sleep(lag_interval_seconds)
+        lag = loop.time() - expected
+
+        lag_stats["samples"] += 1
+        lag_stats["total"] += lag
+        lag_stats["max"] = max(lag_stats["max"], lag)
+        if lag > lag_threshold_seconds:
+            lag_stats["slow"] += 1
+            log_debug(f"Event loop lagged {lag:.3f} seconds")
+
+
+def timed_handle_run(handle):
+    started = time.perf_counter()
+    handle_run(handle)
+    duration = time.perf_counter() - started
+    if duration > slow_callback_seconds:
+        lag_stats["slow_callbacks"] += 1
+        log_debug(
+            f"Slow callback took {duration:.3f} seconds: {describe_handle(handle)}"
+        )
+
+
+def describe_handle(handle):
+    # Task steps are bound to their task, whose repr names the coroutine and where it is
+    task = getattr(handle._callback, "__self__", None)
+    if isinstance(task, asyncio.Task):
+        return repr(task)
+    return repr(handle)
+
+
+def start_lag_monitor():
+    global lag_monitor
+    if lag_monitor is not None:
+        return
+
+    for key in lag_stats:
+        lag_stats[key] = 0
+
+    # asyncio debug mode would also report slow callbacks, but it records a stack for
+    # every callback and coroutine, timing the callbacks directly only costs two clock reads
+    asyncio.Handle._run = timed_handle_run
+
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+
+
+def stop_lag_monitor():
+    global lag_monitor
+    if lag_monitor is None:
+        return
+
+    lag_monitor.cancel()
+    lag_monitor = None
+
+    asyncio.Handle._run = handle_run
+
+
+def sample_stacks(thread_id, stop, samples):
+    while not stop.wait(profile_interval_seconds):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None and len(stack) < profile_stack_depth:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+            )
+            frame = frame.f_back
+        samples[tuple(reversed(stack))] += 1
+
+
+def start_profiler():
+    profiler["samples"] = Counter()
+    profiler["stop"] = threading.Event()
+    profiler["thread"] = threading.Thread(
+        target=sample_stacks,
+        args=(threading.get_ident(), profiler["stop"], profiler["samples"]),
+        daemon=True,
+    )
+    profiler["thread"].start()
+
+
+def stop_profiler():
+    profiler["stop"].set()
+    profiler["thread"].join()
+    profiler["thread"] = None
+
+    if profiler["timer"] is not None:
+        profiler["timer"].cancel()
+        profiler["timer"] = None
+
+    samples = profiler["samples"]
+    total = max(sum(samples.values()), 1)
+
+    leaves = Counter()
+    for stack, count in samples.items():
+        if len(stack) > 0:
+            leaves[stack[-1]] += count
+
+    report = f"{total} samples every {profile_interval_seconds * 1000:.0f}ms\n\n"
+    report += "Hottest functions:\n"
+    for leaf, count in leaves.most_common(30):
+        report += f"{count / total:6.1%} {leaf}\n"
+
+    report += "\nHottest paths:\n"
+    for stack, count in samples.most_common(15):
+        report += f"\n{count / total:6.1%}\n"
+        for frame in stack:
+            report += f"    {frame}\n"
+
+    return report
+
+
+async def send_profile(ctx, report):
+    await ctx.send(
+        file=discord.File(io.BytesIO(report.encode()), filename="profile.txt")
+    )
+
+
+async def finish_profile(ctx, seconds):
+    await asyncio.sleep(seconds)
+    profiler["timer"] = None
+    report = stop_profiler()
+    await send_profile(ctx, report)
+
+
+### END Profiling utilities
+
 ### Debug commands
 
 
@@ -851,21 +1893,21 @@ async def test(ctx):
 
 
 @bot.command(name="commandhistory")
-async def get_command_history(ctx, arg=15):
+async def get_command_history(ctx, arg=15, start=None, end=None):
     if str(ctx.channel.id) != debug_channel:
         command_history(
             f"commandhistory attempted in channel {ctx.channel.id} by {ctx.author.id}"
         )
 
     if arg == "full":
-        await send_file(ctx, "command_history.txt")
+        await queue_file_upload(ctx, "command_history.txt", start, end)
         return
 
     await send_file_lines(ctx, arg, "command_history.txt")
 
 
 @bot.command(name="pointhistory")
-async def get_point_history(ctx, arg=15):
+async def get_point_history(ctx, arg=15, start=None, end=None):
     if str(ctx.channel.id) != debug_channel:
         command_history(
             f"pointhistory attempted in channel {ctx.channel.id} by {ctx.author.id}"
@@ -874,26 +1916,146 @@ async def get_point_history(ctx, arg=15):
     print(type(arg))
 
     if arg == "full":
-        await send_file(ctx, "point_history.txt")
+        await queue_file_upload(ctx, "point_history.txt", start, end)
         return
 
     await send_file_lines(ctx, arg, "point_history.txt")
 
 
 @bot.command(name="errorlog")
-async def get_error_log(ctx, arg=15):
+async def get_error_log(ctx, arg=15, start=None, end=None):
     if str(ctx.author.id) != admin:
         command_history(
             f"errorlog attempted in channel {ctx.channel.id} by {ctx.author.id}"
         )
 
     if arg == "full":
-        await send_file(ctx, "error_log.txt")
+        await queue_file_upload(ctx, "error_log.txt", start, end)
         return
 
     await send_file_lines(ctx, arg, "error_log.txt")
 
 
+@bot.command(name="jobstats")
+async def get_job_stats(ctx):
+    if str(ctx.author.id) != admin:
+        command_history(f"non admin using jobstats: {ctx.author.id}")
+        return
+
+    stats = "Job scheduler stats:\n"
+    for job_class, job_stat in job_stats.items():
+        average_wait = job_stat["wait_seconds"] / max(job_stat["completed"], 1)
+        stats += (
+            f"{job_class} - queued {job_stat['queued']} (max {job_stat['max_queued']}), "
+            f"running {job_stat['running']}/{job_classes[job_class]['limit']}, "
+            f"completed {job_stat['completed']}, shed {job_stat['shed']}, aged {job_stat['aged']}, "
+            f"avg wait {average_wait:.2f}s\n"
+        )
+
+    await ctx.send(stats)
+
+
+@bot.command(name="lag")
+async def lag(ctx, arg=None):
+    if str(ctx.author.id) != admin:
+        command_history(f"non admin using lag: {ctx.author.id}")
+        return
+
+    command_history(f"{ctx.author.id} used lag with argument {arg}")
+
+    if arg == "on":
+        start_lag_monitor()
+        await ctx.send("Event loop lag monitor started, slow callbacks go to debug.txt")
+        return
+
+    if arg == "off":
+        stop_lag_monitor()
+        await ctx.send("Event loop lag monitor stopped")
+        return
+
+    if lag_monitor is None:
+        await ctx.send("Event loop lag monitor is off, start it with !lag on")
+        return
+
+    average_lag = lag_stats["total"] / max(lag_stats["samples"], 1)
+    await ctx.send(
+        f"Event loop lag over {lag_stats['samples']} samples: avg {average_lag * 1000:.1f}ms, "
+        f"max {lag_stats['max'] * 1000:.1f}ms, {lag_stats['slow']} above {lag_threshold_seconds * 1000:.0f}ms, "
+        f"{lag_stats['slow_callbacks']} callback(s) above {slow_callback_seconds * 1000:.0f}ms"
+    )
+
+
+@bot.command(name="profile")
+async def profile(ctx, arg=None, seconds=30):
+    if str(ctx.author.id) != admin:
+        command_history(f"non admin using profile: {ctx.author.id}")
+        return
+
+    command_history(f"{ctx.author.id} used profile with arguments {arg} {seconds}")
+
+    if arg == "start":
+        if profiler["thread"] is not None:
+            await ctx.send("Profiler is already running, stop it with !profile stop")
+            return
+
+        seconds = min(max(get_int(seconds, 30), 1), profile_max_seconds)
+        start_profiler()
+        profiler["timer"] = asyncio.create_task(finish_profile(ctx, seconds))
+        await ctx.send(f"Profiling for {seconds} seconds")
+        return
+
+    if arg == "stop":
+        if profiler["thread"] is None:
+            await ctx.send("Profiler is not running")
+            return
+
+        report = stop_profiler()
+        await send_profile(ctx, report)
+        return
+
+    await ctx.send("profile usage: !profile start [seconds] | !profile stop")
+
+
+@bot.command(name="reststats")
+async def get_rest_stats(ctx):
+    if str(ctx.author.id) != admin:
+        command_history(f"non admin using reststats: {ctx.author.id}")
+        return
+
+    stats = "REST client stats:\n"
+    for route, route_stats in rest_stats.items():
+        stats += (
+            f"{route} - calls {route_stats['calls']}, merged {route_stats['merged']}, "
+            f"429s avoided {route_stats['throttled']}, 429s hit {route_stats['rate_limited']}\n"
+        )
+
+    await ctx.send(stats)
+
+
+@bot.command(name="syncstatus")
+async def get_sync_status(ctx):
+    if str(ctx.author.id) != admin:
+        command_history(f"non admin using syncstatus: {ctx.author.id}")
+        return
+
+    if sheets_worker_status["last_sync"] is None:
+        status = "Sheets worker has not synced yet"
+    else:
+        status = (
+            f"Last sync {sheets_worker_status['last_sync']:%Y-%m-%d %I:%M%p}, "
+            f"{sheets_worker_status['users']} users, "
+            f"read {sheets_worker_status['read_seconds']:.2f}s, "
+            f"write {sheets_worker_status['write_seconds']:.2f}s, "
+            f"round trip {sheets_worker_status['round_trip_seconds']:.2f}s"
+        )
+
+    status += f"\nPending changes: {leaderboard_changes['pending']}"
+    if sheets_worker_status["error"] is not None:
+        status += f"\nLast error: {sheets_worker_status['error']}"
+
+    await ctx.send(status)
+
+
 ### END Debug commands
 
 
@@ -905,3 +2067,6 @@ try:
 finally:
     db.close()
     print("DB closed")
+    if sheets_worker_process is not None:
+        sheets_worker_process.terminate()
+        print("Sheets worker stopped")
@@ -0,0 +1,61 @@
+import os
+from datetime import datetime, timedelta
+
+
+### Helper functions ###
+def get_env_value(key):
+    value = os.getenv(key)
+
+    assert value is not None
+
+    return value
+
+
+def get_worker_address():
+    return ("localhost", int(os.getenv("SHEETS_WORKER_PORT", "6390")))
+
+
+def get_worker_authkey():
+    # The bot generates the key when it spawns the worker, otherwise it must be set
+    return bytes.fromhex(get_env_value("SHEETS_WORKER_KEY"))
+
+
+### END ###
+
+### Constants
+
+# Windowed leaderboards and how many days they cover, including today
+leaderboard_windows = {
+    "week": 7,
+    "month": 30,
+}
+
+### END Constants
+
+### Queries
+
+
+def get_window_leaderboard(db, days, limit=-1):
+    start_day = datetime.now() - timedelta(days=days - 1)
+
+    # Range scan over the (day, user_id) key, cost follows the window size
+    c = db.cursor()
+    c.execute(
+        """
+    SELECT daily_doubloons.user_id, users.username, SUM(daily_doubloons.delta) AS total
+    FROM daily_doubloons
+    JOIN users ON users.id = daily_doubloons.user_id
+    WHERE daily_doubloons.day >= ?
+    GROUP BY daily_doubloons.user_id
+    HAVING total > 0
+    ORDER BY total DESC
+    LIMIT ?
+    """,
+        (f"{start_day:%Y-%m-%d}", limit),
+    )
+    users = c.fetchall()
+    c.close()
+    return users
+
+
+### END Queries
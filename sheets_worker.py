@@ -0,0 +1,237 @@
+from dotenv import load_dotenv
+import sqlite3
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from datetime import datetime
+import time
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+from leaderboard_queries import (
+    get_env_value,
+    get_window_leaderboard,
+    get_worker_address,
+    get_worker_authkey,
+    leaderboard_windows,
+)
+
+
+### Constants
+
+# Worksheet names for the windowed leaderboards
+leaderboard_window_sheets = {
+    "week": "Weekly",
+    "month": "Monthly",
+}
+
+### END Constants
+
+### Snapshot queries
+
+
+def get_sorted_users(db):
+    c = db.cursor()
+    c.execute(
+        """
+    SELECT id, username, doubloons
+    FROM users
+    ORDER BY doubloons DESC, id DESC
+    """
+    )
+    users = c.fetchall()
+    c.close()
+    return users
+
+
+def get_rank_names(db):
+    # Column order of the Ranks worksheet, lowest tier first
+    c = db.cursor()
+    c.execute("SELECT name FROM rank_tiers ORDER BY threshold")
+    rank_names = [tier[0] for tier in c.fetchall()]
+    c.close()
+    return rank_names
+
+
+def get_rank_columns(db, rank_names):
+    rank_columns = []
+    c = db.cursor()
+    for rank in rank_names:
+        # Served straight from the (rank, doubloons) index
+        c.execute(
+            """
+        SELECT username
+        FROM users
+        WHERE rank = ?
+        ORDER BY doubloons DESC
+        """,
+            (rank,),
+        )
+        rank_columns.append([user[0] for user in c.fetchall()])
+    c.close()
+    return rank_columns
+
+
+def read_snapshot(db):
+    # One read transaction, WAL mode keeps it consistent while the bot writes
+    db.execute("BEGIN")
+    try:
+        sorted_users = get_sorted_users(db)
+        rank_names = get_rank_names(db)
+        rank_columns = get_rank_columns(db, rank_names)
+        window_boards = {
+            window: get_window_leaderboard(db, days)
+            for window, days in leaderboard_windows.items()
+        }
+    finally:
+        db.execute("COMMIT")
+
+    return sorted_users, rank_names, rank_columns, window_boards
+
+
+### END Snapshot queries
+
+### Sheets export
+
+
+def write_leaderboard_sheet(
+    file, sorted_users, rank_names, rank_columns, window_boards
+):
+    sheet = file.open("Leaderboard")
+
+    worksheet = sheet.sheet1
+
+    sheet_values = []
+
+    for user in sorted_users:
+        sheet_values.append([user[1], user[2]])
+
+    worksheet.clear()
+    worksheet.update(f"A1:B{len(sorted_users)}", sheet_values)
+
+    worksheet = sheet.worksheet("Ranks")
+
+    # Row 1 holds the rank headers, size the sheet to the biggest rank
+    row_count = max(len(column) for column in rank_columns) + 1
+    if worksheet.row_count < row_count:
+        worksheet.add_rows(row_count - worksheet.row_count)
+
+    # Tiers live in the DB, so the headers follow them instead of being fixed
+    last_column = chr(ord("A") + len(rank_columns) - 1)
+    worksheet.batch_clear([f"A1:{last_column}"])
+
+    column_updates = [
+        {
+            "range": f"A1:{last_column}1",
+            "values": [[rank.capitalize() for rank in rank_names]],
+        }
+    ]
+    for i, column in enumerate(rank_columns):
+        if len(column) == 0:
+            continue
+        letter = chr(ord("A") + i)
+        column_updates.append(
+            {
+                "range": f"{letter}2:{letter}{len(column) + 1}",
+                "majorDimension": "COLUMNS",
+                "values": [column],
+            }
+        )
+
+    worksheet.batch_update(column_updates)
+
+    for window, users in window_boards.items():
+        title = leaderboard_window_sheets[window]
+        try:
+            worksheet = sheet.worksheet(title)
+        except gspread.WorksheetNotFound:
+            worksheet = sheet.add_worksheet(title, max(len(users), 1), 2)
+
+        # The tab may have been created on a quiet day, grow it with the board
+        if worksheet.row_count < len(users):
+            worksheet.add_rows(len(users) - worksheet.row_count)
+
+        worksheet.clear()
+        if len(users) > 0:
+            worksheet.update(
+                f"A1:B{len(users)}", [[user[1], user[2]] for user in users]
+            )
+
+
+def run_sync(db, file):
+    started = time.monotonic()
+    sorted_users, rank_names, rank_columns, window_boards = read_snapshot(db)
+    read_seconds = time.monotonic() - started
+
+    started = time.monotonic()
+    write_leaderboard_sheet(file, sorted_users, rank_names, rank_columns, window_boards)
+    write_seconds = time.monotonic() - started
+
+    return {
+        "status": "ok",
+        "users": len(sorted_users),
+        "read_seconds": read_seconds,
+        "write_seconds": write_seconds,
+    }
+
+
+### END Sheets export
+
+### Worker
+
+
+def serve():
+    load_dotenv()
+    db_path = get_env_value("DB_PATH")
+
+    # Google sheets config
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive",
+    ]
+
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(
+        "google_sheet.json", scopes  # type: ignore this function accepts arrays...
+    )
+
+    file = gspread.authorize(credentials)
+    # END Google sheets config
+
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, isolation_level=None)
+
+    with Listener(get_worker_address(), authkey=get_worker_authkey()) as listener:
+        print(f"Sheets worker listening on {listener.address}")
+        while True:
+            # A bad client must not take the worker down, drop it and keep serving
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, OSError) as e:
+                print(f"{datetime.now():%Y-%m-%d %I:%M%p} - Rejected client: {e!r}")
+                continue
+
+            with conn:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError) as e:
+                    print(f"{datetime.now():%Y-%m-%d %I:%M%p} - Dropped client: {e!r}")
+                    continue
+
+                if request != "sync":
+                    result = {"status": "error", "error": f"Unknown request {request}"}
+                else:
+                    try:
+                        result = run_sync(db, file)
+                    except Exception as e:
+                        result = {"status": "error", "error": repr(e)}
+                        print(f"{datetime.now():%Y-%m-%d %I:%M%p} - Sync failed: {e!r}")
+
+                try:
+                    conn.send(result)
+                except OSError as e:
+                    # The bot gave up waiting, the next request starts fresh
+                    print(f"{datetime.now():%Y-%m-%d %I:%M%p} - Dropped client: {e!r}")
+
+
+### END Worker
+
+
+if __name__ == "__main__":
+    serve()